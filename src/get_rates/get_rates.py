@@ -5,67 +5,85 @@
 """
 Script to snarf nominal and real rates from the Treasury Department site
 and output in CSV format.
+
+Requires httpx; h2 (for HTTP/2) and lxml are used when installed.  See
+requirements.txt alongside this script.
 """
+import contextlib
 import datetime
+import functools
+import hashlib
+import json
 import logging
-import xml.etree.ElementTree as ET
+import os
+import re
+import sys
+import tempfile
+import time
+import urllib.parse
+from collections.abc import Iterable, Iterator, Mapping
+from concurrent.futures import ThreadPoolExecutor
+# Only used in annotations, where it means "ElementTree-compatible element":
+# when lxml is installed the elements are really lxml.etree._Element objects.
 from xml.etree.ElementTree import Element
 from dataclasses import dataclass
-from enum import Enum
-import decimal  # for getcontext()
-from decimal import Decimal
+from pathlib import Path
+
+import httpx
 
-import requests
+try:
+    # needed for httpx to speak HTTP/2; without it we stick to HTTP/1.1
+    import h2  # noqa: F401
 
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
 
-class RatesType(Enum):
-    """Used to distinguish nominal vs real rates."""
+try:
+    # libxml2-backed, and API-compatible for everything we use below
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
-    NOMINAL = "BC_"  # use US Treasury prefixes
-    REAL = "TC_"
 
+# Used to distinguish nominal vs real rates (these are US Treasury prefixes)
+NOMINAL_PREFIX = "BC_"
+REAL_PREFIX = "TC_"
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class Rates:
     """Class representing a particular set of treasury yields."""
 
-    rt: RatesType
+    prefix: str
     date: str
-    r5y: Decimal
-    r10y: Decimal
-    r20y: Decimal
-    r30y: Decimal
+    r5y: str
+    r10y: str
+    r20y: str
+    r30y: str
 
-    def __init__(self, properties: Element, rt: RatesType):
+    @classmethod
+    def from_properties(cls, properties: Element, prefix: str) -> "Rates":
         """
         Given a "properties" element from the Treasury Department XML document,
         return a corresponding Rates object.
         """
-        self.rt = rt
-
-        for child in properties:
-            child_tag = child.tag
-
-            if child_tag.endswith("DATE"):
-                self.date = extract_stripped_text(child)
-            elif child_tag.endswith("5YEAR"):
-                self.r5y = extract_decimal(child)
-            elif child_tag.endswith("10YEAR"):
-                self.r10y = extract_decimal(child)
-            elif child_tag.endswith("20YEAR"):
-                self.r20y = extract_decimal(child)
-            elif child_tag.endswith("30YEAR"):
-                self.r30y = extract_decimal(child)
+        fields = {
+            name: properties.findtext(path, "").strip()
+            for name, path in _FIELD_PATHS[prefix]
+        }
+        return cls(prefix=prefix, **fields)
 
     def print_as_csv(self):
         """Output a rates as CSV text."""
-        prefix = self.rt.value
-        print("NAME,VALUE")
-        print(f"NEW_DATE,{self.date}")
-        print(f"{prefix}5YEAR,{self.r5y}")
-        print(f"{prefix}10YEAR,{self.r10y}")
-        print(f"{prefix}20YEAR,{self.r20y}")
-        print(f"{prefix}30YEAR,{self.r30y}")
+        sys.stdout.write(
+            "NAME,VALUE\n"
+            f"NEW_DATE,{self.date}\n"
+            f"{self.prefix}5YEAR,{self.r5y}\n"
+            f"{self.prefix}10YEAR,{self.r10y}\n"
+            f"{self.prefix}20YEAR,{self.r20y}\n"
+            f"{self.prefix}30YEAR,{self.r30y}\n"
+        )
 
 
 TREASURY_RATE_XML_URL = (
@@ -80,76 +98,334 @@ BASE_NOMINAL_XML_URL = f"{TREASURY_RATE_XML_URL}?{DATA_NAME}={NOMINAL_DATA_VALUE
 BASE_REAL_XML_URL = f"{TREASURY_RATE_XML_URL}?{DATA_NAME}={REAL_DATA_VALUE}"
 
 
-def find_all_ending_with(e: Element, tag: str) -> list[Element]:
+def make_client(transport: httpx.BaseTransport | None = None) -> httpx.Client:
     """
-    Return all child Elements of 'e' that have a tag that ends with 'tag'.
+    Return an httpx.Client set up for fetching the Treasury documents.
+    'transport' is only there to let tests stand in for the server.
     """
-    return [child for child in e if child.tag.endswith(tag)]
+    # unlike requests, httpx does not follow redirects unless asked to
+    return httpx.Client(
+        http2=HTTP2, timeout=60, follow_redirects=True, transport=transport
+    )
+
+
+# Both documents live on the same host, so share one client, letting the
+# concurrent fetches be multiplexed over a single connection under HTTP/2.
+_CLIENT = make_client()
+
+# Fetched documents are kept here, along with the validators and expiry
+# needed to reuse them without (or with only a conditional) request.
+CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "get_rates"
+)
+MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+CHUNK_SIZE = 64 * 1024
 
 
 def find_only_one_ending_with(e: Element, tag: str) -> Element:
     """
-    Version of find_all_ending_with() that asserts there is only one matching element.
+    Return the child Element of 'e' that has a tag that ends with 'tag',
+    asserting there is only one such element.
     """
-    child_elts = find_all_ending_with(e, tag)
-    assert len(child_elts) == 1
-    return child_elts[0]
+    matches = (child for child in e if child.tag.endswith(tag))
+    found = next(matches, None)
+    assert found is not None
+    # only keep scanning for a duplicate when assertions are enabled
+    assert next(matches, None) is None
+    return found
 
 
-def get_last_entry(root: Element) -> Element | None:
+def get_last_entry(chunks: Iterable[bytes]) -> Element | None:
     """
-    Return the last 'entry' Element residing under specified Element.
+    Incrementally parse the XML document made up of 'chunks' and return
+    its last 'entry' Element.  Each earlier entry is cleared once a later
+    one has been seen, so only one is ever held in memory.
     """
-    last_entry: Element
-    found_entry = False
+    last_entry: Element | None = None
+    num_entries = 0
+    parser = ET.XMLPullParser(events=("end",))
+
+    def read_entries() -> None:
+        nonlocal last_entry, num_entries
+        for _, elt in parser.read_events():
+            if elt.tag.endswith("entry"):
+                if last_entry is not None:
+                    last_entry.clear()
+                last_entry = elt
+                num_entries += 1
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        read_entries()
+    parser.close()
+    read_entries()
+
+    logging.debug("number of entries=%d", num_entries)
+    return last_entry
+
+
+def cache_paths(url: str) -> tuple[Path, Path]:
+    """
+    Return the paths of the cached XML document for 'url' and of the
+    JSON metadata describing it.  These are keyed on the data set, i.e.
+    the URL less its month, so each month's document replaces the last
+    one's rather than piling up.
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.urlencode(
+        [
+            (name, value)
+            for name, value in urllib.parse.parse_qsl(parts.query)
+            if name != DATE_VALUE_MONTH_NAME
+        ]
+    )
+    data_set = urllib.parse.urlunsplit(parts._replace(query=query))
+    digest = hashlib.sha1(data_set.encode()).hexdigest()
+    return CACHE_DIR / f"{digest}.xml", CACHE_DIR / f"{digest}.json"
 
-    entries = find_all_ending_with(root, "entry")
-    logging.debug("number of entries=%d", len(entries))
-    for elt in entries:
-        last_entry = elt
-        found_entry = True
 
-    if found_entry:
-        return last_entry
-    else:
-        return None
+def freshness_lifetime(headers: Mapping[str, str]) -> int:
+    """
+    Return the number of seconds a response with the specified headers
+    may be reused without revalidating it with the server.
+    """
+    cache_control = headers.get("Cache-Control", "")
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return 0
+    match = MAX_AGE_RE.search(cache_control)
+    return int(match.group(1)) if match else 0
+
+
+def write_atomically(path: Path, chunks: Iterable[bytes]) -> None:
+    """Write 'chunks' to 'path' such that readers never see a partial file."""
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as f:
+        try:
+            f.writelines(chunks)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
 
 
-def extract_stripped_text(e: Element) -> str:
-    """Return stripped text value of specifed Element"""
-    if e is None:
-        return ""
+def read_meta(meta_path: Path) -> dict:
+    """
+    Return the cache metadata stored at 'meta_path', or an empty dict if
+    there is none or it is not usable.
+    """
+    try:
+        meta = json.loads(meta_path.read_text())
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logging.debug("ignoring corrupt %s", meta_path)
+        return {}
+    return meta if isinstance(meta, dict) else {}
+
+
+def discard_cached(url: str) -> None:
+    """Remove anything cached for 'url'."""
+    for path in cache_paths(url):
+        try:
+            path.unlink(missing_ok=True)
+        except OSError as err:
+            logging.debug("could not remove %s: %s", path, err)
+
+
+def write_through(path: Path, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Pass 'chunks' through unchanged while also saving them to 'path'; the
+    file is only put in place once every chunk has been passed through, so
+    readers never see a partial one.  Saving is best effort: if the file
+    cannot be written, the chunks keep flowing and it is just not saved.
+    """
+    try:
+        # unbuffered, so a failed write leaves nothing to flush on close
+        f = tempfile.NamedTemporaryFile(dir=path.parent, delete=False, buffering=0)
+    except OSError as err:
+        logging.debug("not saving %s: %s", path, err)
+        yield from chunks
+        return
+
+    saving = True
+    try:
+        for chunk in chunks:
+            if saving:
+                try:
+                    f.write(chunk)
+                except OSError as err:
+                    logging.debug("not saving %s: %s", path, err)
+                    saving = False
+            yield chunk
+        if saving:
+            try:
+                f.close()
+                os.replace(f.name, path)
+            except OSError as err:
+                logging.debug("not saving %s: %s", path, err)
+    finally:
+        f.close()
+        with contextlib.suppress(OSError):
+            os.unlink(f.name)  # only still there if it was not put in place
+
+
+def parse_cached(xml_path: Path) -> Element | None:
+    """Return the last 'entry' Element of the cached document at 'xml_path'."""
+    with xml_path.open("rb") as f:
+        return get_last_entry(iter(functools.partial(f.read, CHUNK_SIZE), b""))
+
+
+def fetch_cached(url: str, client: httpx.Client) -> Element | None:
+    """
+    Return the last 'entry' Element of the XML document at the specified
+    URL, going through the on-disk cache.  A copy still within the server's
+    max-age is used as is; otherwise it is revalidated with a conditional
+    request, and if it has changed it is parsed as it streams in, while
+    being saved for next time.
+
+    The cache is only an optimization: if it cannot be used before the
+    request is sent, the document is parsed straight off the network; if
+    it cannot be written afterwards, the document just isn't saved.
+    """
+    xml_path, meta_path = cache_paths(url)
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        meta = read_meta(meta_path) if xml_path.exists() else {}
+        if meta.get("url") != url:
+            meta = {}  # e.g. last month's document
+        if meta.get("expires", 0) > time.time():
+            logging.debug("using cached %s", xml_path)
+            return parse_cached(xml_path)
+    except OSError as err:
+        logging.debug("cache unusable for %s: %s", url, err)
+        return fetch_uncached(url, client)
+
+    headers = {}
+    if "etag" in meta:
+        headers["If-None-Match"] = meta["etag"]
+    if "last_modified" in meta:
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    last_entry: Element | None = None
+    with client.stream("GET", url, headers=headers) as response:
+        logging.debug(
+            "status=%d http_version=%s", response.status_code, response.http_version
+        )
+        not_modified = response.status_code == 304
+        if not not_modified:
+            response.raise_for_status()
+            logging.debug(
+                "content-encoding=%s", response.headers.get("Content-Encoding")
+            )
+            # Drop the old copy first, so its validators can never end up
+            # describing a new document that failed to be saved.
+            discard_cached(url)
+            # iter_bytes() decompresses the body as it is read
+            with contextlib.closing(
+                write_through(xml_path, response.iter_bytes())
+            ) as chunks:
+                last_entry = get_last_entry(chunks)
+            meta = {"url": url}
+            if "ETag" in response.headers:
+                meta["etag"] = response.headers["ETag"]
+            if "Last-Modified" in response.headers:
+                meta["last_modified"] = response.headers["Last-Modified"]
+        meta["expires"] = time.time() + freshness_lifetime(response.headers)
+
+    try:
+        # only describe a document that actually got saved
+        if xml_path.exists():
+            write_atomically(meta_path, [json.dumps(meta).encode()])
+    except OSError as err:
+        # the document itself is fine; it just gets revalidated next time
+        logging.debug("could not write %s: %s", meta_path, err)
+
+    if not_modified:
+        try:
+            return parse_cached(xml_path)
+        except OSError as err:
+            logging.debug("cache unusable for %s: %s", url, err)
+            return fetch_uncached(url, client)
+    return last_entry
+
+
+def fetch_uncached(url: str, client: httpx.Client) -> Element | None:
+    """
+    Return the last 'entry' Element of the XML document at the specified
+    URL, parsing it straight off the network.
+    """
+    with client.stream("GET", url) as response:
+        logging.debug(
+            "status=%d http_version=%s", response.status_code, response.http_version
+        )
+        response.raise_for_status()
+        return get_last_entry(response.iter_bytes())
 
-    etext = e.text
-    if etext is None:
-        return ""
 
-    return etext.strip()
+def fetch_last_entry(url: str, client: httpx.Client) -> Element | None:
+    """
+    Return the last 'entry' Element of the XML document at the specified
+    URL; see fetch_cached().
+    """
+    try:
+        return fetch_cached(url, client)
+    except ET.ParseError:
+        # don't keep serving a bad document until the server's copy changes
+        discard_cached(url)
+        raise
+
+
+# For each rates prefix, pair each Rates attribute with the path of the child
+# of a "properties" Element it is populated from ("{*}" matches any
+# namespace), so the parser's own find() does the matching rather than a
+# Python loop over every child.  The rates are only ever printed back out,
+# so they are kept as text.
+_FIELD_PATHS = {
+    prefix: (
+        ("date", "{*}NEW_DATE"),
+        ("r5y", f"{{*}}{prefix}5YEAR"),
+        ("r10y", f"{{*}}{prefix}10YEAR"),
+        ("r20y", f"{{*}}{prefix}20YEAR"),
+        ("r30y", f"{{*}}{prefix}30YEAR"),
+    )
+    for prefix in (NOMINAL_PREFIX, REAL_PREFIX)
+}
 
 
-def extract_decimal(e: Element) -> Decimal:
-    """Return Decimal value from text of specifed Element"""
-    return Decimal(extract_stripped_text(e))
+@functools.lru_cache(maxsize=1)
+def get_urls(year: int, month: int) -> tuple[str, str]:
+    """
+    Return the nominal and real rate XML URLs for the specified month.
+    Cached, since callers ask for the same month over and over.
+    """
+    date_value_month = f"{year:04d}{month:02d}"
+    return (
+        f"{BASE_NOMINAL_XML_URL}&{DATE_VALUE_MONTH_NAME}={date_value_month}",
+        f"{BASE_REAL_XML_URL}&{DATE_VALUE_MONTH_NAME}={date_value_month}",
+    )
 
 
-def get_rates(url: str, rt: RatesType) -> Rates | None:
+def get_rates(
+    url: str, prefix: str, client: httpx.Client | None = None
+) -> Rates | None:
     """
     Get the XML document at the specified URL, and use its
     contents to build a Rates that is returned.
+
+    If no client is given, the module-level one is used.  The document
+    is cached on disk when possible; see fetch_last_entry().
     """
-    response = requests.get(url, timeout=60)
-    logging.debug("status=%d", response.status_code)
-    root = ET.fromstring(response.content)
+    if client is None:
+        client = _CLIENT
 
     # <root>/entry[last]/content/properties
-    last_elt = get_last_entry(root)
+    last_elt = fetch_last_entry(url, client)
     logging.debug("last_elt=%s", str(last_elt))
     if last_elt is None:
         return None
     content = find_only_one_ending_with(last_elt, "content")
     properties = find_only_one_ending_with(content, "properties")
 
-    return Rates(properties, rt)
+    return Rates.from_properties(properties, prefix)
 
 
 def main() -> None:
@@ -160,20 +436,18 @@ def main() -> None:
         datefmt="%Y-%m-%dT%H:%M:%S%z",
     )
 
-    # I think this should be good enough
-    decimal.getcontext().prec = 6
-
     # build URLS
     today = datetime.date.today()
-    date_value_month = today.strftime("%Y%m")
-    nominal_url = f"{BASE_NOMINAL_XML_URL}&{DATE_VALUE_MONTH_NAME}={date_value_month}"
-    real_url = f"{BASE_REAL_XML_URL}&{DATE_VALUE_MONTH_NAME}={date_value_month}"
+    nominal_url, real_url = get_urls(today.year, today.month)
     logging.debug("nominal_url=%s", nominal_url)
     logging.debug("real_url=%s", real_url)
 
-    # build our Rates…
-    nominal_rates = get_rates(nominal_url, RatesType.NOMINAL)
-    real_rates = get_rates(real_url, RatesType.REAL)
+    # build our Rates, fetching both documents concurrently…
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        nominal_future = executor.submit(get_rates, nominal_url, NOMINAL_PREFIX)
+        real_future = executor.submit(get_rates, real_url, REAL_PREFIX)
+        nominal_rates = nominal_future.result()
+        real_rates = real_future.result()
 
     # …and print them out
     if nominal_rates is not None:
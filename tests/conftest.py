@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# get_rates.py is a standalone script, not an installed package
+sys.path.insert(0, str(Path(__file__).parent.parent / "src" / "get_rates"))
@@ -0,0 +1,206 @@
+"""Tests for the on-disk caching of the Treasury XML documents."""
+import contextlib
+import errno
+import tempfile
+
+import httpx
+import pytest
+
+import get_rates
+
+URL = "https://example.com/rates.xml"
+
+XML = b"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"
+      xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices"
+      xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata">
+  <entry>
+    <content type="application/xml">
+      <m:properties>
+        <d:NEW_DATE>2024-05-01T00:00:00</d:NEW_DATE>
+        <d:BC_5YEAR>4.60</d:BC_5YEAR>
+        <d:BC_10YEAR>4.63</d:BC_10YEAR>
+        <d:BC_20YEAR>4.85</d:BC_20YEAR>
+        <d:BC_30YEAR>4.75</d:BC_30YEAR>
+      </m:properties>
+    </content>
+  </entry>
+  <entry>
+    <content type="application/xml">
+      <m:properties>
+        <d:NEW_DATE>2024-05-02T00:00:00</d:NEW_DATE>
+        <d:BC_5YEAR> 4.52 </d:BC_5YEAR>
+        <d:BC_10YEAR>4.58</d:BC_10YEAR>
+        <d:BC_20YEAR>4.81</d:BC_20YEAR>
+        <d:BC_30YEAR>4.72</d:BC_30YEAR>
+      </m:properties>
+    </content>
+  </entry>
+</feed>
+"""
+
+EXPECTED = get_rates.Rates(
+    prefix="BC_",
+    date="2024-05-02T00:00:00",
+    r5y="4.52",
+    r10y="4.58",
+    r20y="4.81",
+    r30y="4.72",
+)
+
+
+class StubClient:
+    """Stands in for httpx.Client, answering stream() with canned responses."""
+
+    def __init__(self, *responses: httpx.Response):
+        self.responses = list(responses)
+        self.sent_headers: list[dict] = []
+
+    @contextlib.contextmanager
+    def stream(self, method, url, headers=None):
+        self.sent_headers.append(headers or {})
+        response = self.responses.pop(0)
+        response.request = httpx.Request(method, url)
+        yield response
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    path = tmp_path / "cache"
+    monkeypatch.setattr(get_rates, "CACHE_DIR", path)
+    return path
+
+
+@pytest.mark.parametrize(
+    "cache_control, expected",
+    [
+        ("max-age=300", 300),
+        ("public, max-age=60, must-revalidate", 60),
+        ("no-cache, max-age=300", 0),
+        ("no-store", 0),
+        ("", 0),
+    ],
+)
+def test_freshness_lifetime(cache_control, expected):
+    headers = {"Cache-Control": cache_control} if cache_control else {}
+    assert get_rates.freshness_lifetime(headers) == expected
+
+
+def test_fresh_copy_skips_request():
+    client = StubClient(
+        httpx.Response(200, content=XML, headers={"Cache-Control": "max-age=300"})
+    )
+
+    assert get_rates.get_rates(URL, "BC_", client) == EXPECTED
+    assert get_rates.get_rates(URL, "BC_", client) == EXPECTED
+    assert len(client.sent_headers) == 1
+
+
+def test_stale_copy_is_revalidated():
+    client = StubClient(
+        httpx.Response(200, content=XML, headers={"ETag": '"v1"'}),
+        httpx.Response(304),
+    )
+
+    assert get_rates.get_rates(URL, "BC_", client) == EXPECTED
+    assert get_rates.get_rates(URL, "BC_", client) == EXPECTED
+    assert client.sent_headers == [{}, {"If-None-Match": '"v1"'}]
+
+
+def test_error_response_is_not_cached(cache_dir):
+    client = StubClient(httpx.Response(500, content=b"oops"))
+
+    with pytest.raises(httpx.HTTPStatusError):
+        get_rates.get_rates(URL, "BC_", client)
+    assert list(cache_dir.iterdir()) == []
+
+
+def test_unparsable_copy_is_discarded(cache_dir):
+    client = StubClient(
+        httpx.Response(200, content=b"<feed>", headers={"ETag": '"v1"'}),
+        httpx.Response(200, content=XML),
+    )
+
+    with pytest.raises(get_rates.ET.ParseError):
+        get_rates.get_rates(URL, "BC_", client)
+    assert list(cache_dir.iterdir()) == []
+    assert get_rates.get_rates(URL, "BC_", client) == EXPECTED
+    assert client.sent_headers == [{}, {}]
+
+
+def test_corrupt_metadata_is_ignored():
+    client = StubClient(
+        httpx.Response(200, content=XML, headers={"ETag": '"v1"'}),
+        httpx.Response(200, content=XML),
+    )
+    get_rates.get_rates(URL, "BC_", client)
+    _, meta_path = get_rates.cache_paths(URL)
+    meta_path.write_text("[]")
+
+    assert get_rates.get_rates(URL, "BC_", client) == EXPECTED
+    assert client.sent_headers[1] == {}
+
+
+def test_unusable_cache_falls_back_to_network(tmp_path, monkeypatch):
+    (tmp_path / "file").touch()
+    monkeypatch.setattr(get_rates, "CACHE_DIR", tmp_path / "file" / "cache")
+    client = StubClient(httpx.Response(200, content=XML))
+
+    assert get_rates.get_rates(URL, "BC_", client) == EXPECTED
+
+
+def test_write_atomically_removes_partial_file(tmp_path):
+    def chunks():
+        yield b"partial"
+        raise httpx.ReadError("connection lost")
+
+    with pytest.raises(httpx.ReadError):
+        get_rates.write_atomically(tmp_path / "out.xml", chunks())
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_failed_save_does_not_refetch(cache_dir, monkeypatch):
+    real_named_temporary_file = tempfile.NamedTemporaryFile
+
+    def full_disk(*args, **kwargs):
+        f = real_named_temporary_file(*args, **kwargs)
+
+        def write(data):
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        f.write = write
+        return f
+
+    monkeypatch.setattr(tempfile, "NamedTemporaryFile", full_disk)
+    client = StubClient(httpx.Response(200, content=XML, headers={"ETag": '"v1"'}))
+
+    assert get_rates.get_rates(URL, "BC_", client) == EXPECTED
+    assert len(client.sent_headers) == 1
+    assert list(cache_dir.iterdir()) == []
+
+
+def test_write_through_removes_partial_file(tmp_path):
+    def chunks():
+        yield b"partial"
+        raise httpx.ReadError("connection lost")
+
+    with pytest.raises(httpx.ReadError):
+        list(get_rates.write_through(tmp_path / "out.xml", chunks()))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_new_month_replaces_previous(cache_dir):
+    base_url = "https://example.com/rates.xml?data=yield_curve"
+    april = f"{base_url}&{get_rates.DATE_VALUE_MONTH_NAME}=202404"
+    may = f"{base_url}&{get_rates.DATE_VALUE_MONTH_NAME}=202405"
+    client = StubClient(
+        httpx.Response(200, content=XML, headers={"Cache-Control": "max-age=300"}),
+        httpx.Response(200, content=XML, headers={"ETag": '"v1"'}),
+    )
+
+    get_rates.get_rates(april, "BC_", client)
+    assert get_rates.get_rates(may, "BC_", client) == EXPECTED
+    # April's fresh copy was not reused for May, and May's replaced it
+    assert client.sent_headers == [{}, {}]
+    assert sorted(cache_dir.iterdir()) == sorted(get_rates.cache_paths(may))
+    assert get_rates.cache_paths(april) == get_rates.cache_paths(may)
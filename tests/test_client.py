@@ -0,0 +1,26 @@
+"""Tests for the httpx client used to fetch the Treasury documents."""
+import httpx
+import pytest
+
+import get_rates
+from test_cache import EXPECTED, XML
+
+OLD_URL = "https://example.com/old/rates.xml"
+NEW_URL = "https://example.com/new/rates.xml"
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_rates, "CACHE_DIR", tmp_path / "cache")
+
+
+def serve(request: httpx.Request) -> httpx.Response:
+    if request.url == OLD_URL:
+        return httpx.Response(301, headers={"Location": NEW_URL})
+    return httpx.Response(200, content=XML)
+
+
+def test_redirect_is_followed():
+    client = get_rates.make_client(transport=httpx.MockTransport(serve))
+
+    assert get_rates.get_rates(OLD_URL, "BC_", client) == EXPECTED